@@ -1,21 +1,138 @@
 from aqt import mw
 from aqt.utils import showText, qconnect, showInfo, showCritical
 from aqt.qt import *
-import json
-import requests
 import os
+import re
 import time
 import threading
 import sys
 from aqt.gui_hooks import card_will_show, webview_did_receive_js_message
+from anki.utils import strip_html
+
+# Prefer orjson for parsing streamed chunks when it is available
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    from json import loads as _json_loads
+
+# Debug output is enabled by the ANKI_LLM_DEBUG environment variable or the
+# debug_mode config setting; the flag is refreshed whenever the config changes
+_DEBUG_ENV = bool(os.environ.get('ANKI_LLM_DEBUG'))
+_DEBUG_ENABLED = _DEBUG_ENV
 
 # Debug function to help troubleshoot streaming
 def debug_print(msg):
     """Print debug messages to console"""
-    config = get_config()
-    if config.get('debug_mode', False) or os.environ.get('ANKI_LLM_DEBUG'):
+    if _DEBUG_ENABLED:
         print(f"[LLM Quiz Debug] {msg}", file=sys.stderr)
 
+# Shared HTTP session so keep-alive connections are reused between LLM calls
+# and across quiz dialogs for the whole Anki session
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session():
+    """Get the shared requests session, creating it on first use"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            # Imported here so loading the add-on doesn't pay for requests at startup
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            # One pool per host (OpenAI and LM Studio); retries are handled by process_response
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=10, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Content-Type": "application/json"})
+            _SESSION = session
+        return _SESSION
+
+# Streamed tokens are shown in batches of at most this many characters
+# or after this many seconds, whichever comes first
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.05
+
+# Patterns used to clean up LLM responses
+_THINK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+def iter_stream_lines(response, chunk_size=4096):
+    """Yield the raw byte lines of a streamed response as soon as they arrive"""
+    raw = response.raw
+    raw.decode_content = True
+    # read1() returns whatever is available instead of waiting for a full chunk;
+    # older urllib3 versions lack it, so fall back to requests' own chunking
+    if hasattr(raw, "read1"):
+        chunks = iter(lambda: raw.read1(chunk_size), b"")
+    else:
+        chunks = response.iter_content(chunk_size=None)
+    
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            yield bytes(buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+        del buffer[:start]
+    if buffer:
+        yield bytes(buffer).rstrip(b"\r")
+
+# Results of OpenAI connection tests, keyed by (api_key, model), as
+# (valid, time.monotonic() of the check); successes are reused for KEY_VALIDATION_TTL seconds
+_KEY_VALIDATION_CACHE = {}
+KEY_VALIDATION_TTL = 300
+
+class ThinkTagFilter:
+    """Drops <think>...</think> sections from streamed text as it arrives"""
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+    
+    def __init__(self):
+        self.in_think = False
+        # Trailing text that may be the start of a tag split across chunks
+        self.tail = ""
+    
+    def feed(self, text):
+        """Return the part of text that should be displayed"""
+        data = self.tail + text
+        self.tail = ""
+        visible = []
+        while data:
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            idx = data.find(tag)
+            if idx == -1:
+                keep = self._partial_tag_length(data, tag)
+                if not self.in_think:
+                    visible.append(data[:len(data) - keep])
+                self.tail = data[len(data) - keep:]
+                break
+            if not self.in_think:
+                visible.append(data[:idx])
+            data = data[idx + len(tag):]
+            self.in_think = not self.in_think
+        return "".join(visible)
+    
+    def flush(self):
+        """Return any held-back text once the stream has ended"""
+        tail = "" if self.in_think else self.tail
+        self.in_think = False
+        self.tail = ""
+        return tail
+    
+    @staticmethod
+    def _partial_tag_length(data, tag):
+        """Length of the longest suffix of data that is a prefix of tag"""
+        for size in range(min(len(tag) - 1, len(data)), 0, -1):
+            if tag.startswith(data[-size:]):
+                return size
+        return 0
+
 # Custom exceptions for error handling
 class LLMError(Exception):
     """Base exception for LLM-related errors"""
@@ -33,9 +150,15 @@ class ConfigurationError(LLMError):
     """Raised when configuration is invalid"""
     pass
 
+# Cached copy of the add-on config, refreshed when the config is saved or edited
+_CONFIG_CACHE = None
+
 # Get configuration from Anki's config system
 def get_config():
-    """Get the add-on config from Anki's configuration system"""
+    """Get the add-on config, loading it from Anki's configuration system on first use"""
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is not None:
+        return _CONFIG_CACHE
     config = mw.addonManager.getConfig(__name__)
     if config is None:
         # If config is None, create default config
@@ -48,6 +171,7 @@ def get_config():
             "answer_field_index": 1,
             "timeout": 30,  # Added timeout setting
             "max_retries": 3,  # Added retry setting
+            "history_turns": 4,  # Recent exchanges sent with each request (0 = all)
             "stream_responses": True,  # Added streaming setting
             "debug_mode": False,  # Added debug setting
             "system_prompt": """You are an interactive quiz assistant for Anki flashcards.
@@ -67,11 +191,55 @@ IMPORTANT INSTRUCTIONS:
 Remember: Brevity is essential - one point at a time, keep all responses short and focused."""
         }
         save_config(config)
-    return config
+    else:
+        _update_config_cache(config)
+    return _CONFIG_CACHE
 
 def save_config(config):
     """Save the config to Anki's configuration system"""
     mw.addonManager.writeConfig(__name__, config)
+    _update_config_cache(config)
+
+def on_config_updated(new_config):
+    """Refresh the cached config after it is edited in Anki's add-on config editor"""
+    _update_config_cache(new_config)
+
+def _update_config_cache(config):
+    """Replace the cached config contents and refresh the debug flag"""
+    global _CONFIG_CACHE, _DEBUG_ENABLED
+    if _CONFIG_CACHE is None:
+        _CONFIG_CACHE = dict(config)
+    else:
+        _CONFIG_CACHE.clear()
+        _CONFIG_CACHE.update(config)
+    _DEBUG_ENABLED = _DEBUG_ENV or bool(_CONFIG_CACHE.get('debug_mode', False))
+
+# Upper bound for the numeric config fields; only the lower bounds are enforced
+MAX_INT_FIELD = 2147483647
+
+# OpenAI models offered in the configuration dialog
+OPENAI_MODELS = (
+    "gpt-5",
+    "gpt-5-mini",
+    "gpt-5-nano",
+    "gpt-4",
+    "gpt-4-turbo",
+    "gpt-4.1",
+    "gpt-4.1-mini",
+    "gpt-4.1-nano",
+    "gpt-4o",
+    "gpt-4o-mini",
+    "gpt-3.5-turbo",
+    "o1",
+    "o1-mini",
+    "o1-pro",
+    "o1-preview",
+    "o3",
+    "o3-mini",
+    "o3-pro",
+    "o4-mini",
+)
+_OPENAI_MODEL_SET = frozenset(OPENAI_MODELS)
 
 class ConfigDialog(QDialog):
     def __init__(self, parent=None):
@@ -100,47 +268,35 @@ class ConfigDialog(QDialog):
         form.addRow("OpenAI API Key:", self.openai_key)
         
         self.openai_model = QComboBox()
-        self.openai_model.addItems([
-            "gpt-5",
-            "gpt-5-mini",
-            "gpt-5-nano",
-            "gpt-4",
-            "gpt-4-turbo",
-            "gpt-4.1",
-            "gpt-4.1-mini",
-            "gpt-4.1-nano",
-            "gpt-4o",
-            "gpt-4o-mini",
-            "gpt-3.5-turbo",
-            "o1",
-            "o1-mini",
-            "o1-pro",
-            "o1-preview",
-            "o3",
-            "o3-mini",
-            "o3-pro",
-            "o4-mini",
-        ])
+        self.openai_model.addItems(OPENAI_MODELS)
         # Set current selection from config
         current_model = self.config.get("openai_model", "gpt-3.5-turbo")
-        if current_model in [self.openai_model.itemText(i) for i in range(self.openai_model.count())]:
+        if current_model in _OPENAI_MODEL_SET:
             self.openai_model.setCurrentText(current_model)
         form.addRow("OpenAI Model:", self.openai_model)
 
         # Field indices
         self.question_idx = QLineEdit(str(self.config.get("question_field_index", 0)))
+        self.question_idx.setValidator(QIntValidator(0, MAX_INT_FIELD, self))
         form.addRow("Question Field Index:", self.question_idx)
         
         self.answer_idx = QLineEdit(str(self.config.get("answer_field_index", 1)))
+        self.answer_idx.setValidator(QIntValidator(0, MAX_INT_FIELD, self))
         form.addRow("Answer Field Index:", self.answer_idx)
         
         # Advanced settings
         self.timeout = QLineEdit(str(self.config.get("timeout", 30)))
+        self.timeout.setValidator(QIntValidator(1, MAX_INT_FIELD, self))
         form.addRow("Timeout (seconds):", self.timeout)
         
         self.max_retries = QLineEdit(str(self.config.get("max_retries", 3)))
+        self.max_retries.setValidator(QIntValidator(1, MAX_INT_FIELD, self))
         form.addRow("Max Retries:", self.max_retries)
         
+        self.history_turns = QLineEdit(str(self.config.get("history_turns", 4)))
+        self.history_turns.setValidator(QIntValidator(0, MAX_INT_FIELD, self))
+        form.addRow("History Turns (0 = all):", self.history_turns)
+        
         self.stream_responses = QCheckBox("Stream Responses")
         self.stream_responses.setChecked(self.config.get("stream_responses", True))
         form.addRow("", self.stream_responses)
@@ -183,19 +339,25 @@ class ConfigDialog(QDialog):
     
     def test_connection(self):
         """Test the connection to the LLM service"""
+        import requests
+        
         try:
             if self.use_openai.isChecked():
                 if not self.openai_key.text():
                     raise APIKeyError("OpenAI API key is required")
                 
-                response = requests.post(
+                # Skip the (billable) test request if this key and model were validated recently
+                cache_key = (self.openai_key.text(), self.openai_model.currentText())
+                cached = _KEY_VALIDATION_CACHE.get(cache_key)
+                if cached and cached[0] and time.monotonic() - cached[1] < KEY_VALIDATION_TTL:
+                    showInfo("Connection successful! (cached)")
+                    return
+                
+                response = get_session().post(
                     "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {self.openai_key.text()}"
-                    },
+                    headers={"Authorization": f"Bearer {self.openai_key.text()}"},
                     json={
-                        "model": self.openai_model.text(),
+                        "model": self.openai_model.currentText(),
                         "messages": [{"role": "user", "content": "test"}],
                         "max_tokens": 5
                     },
@@ -203,15 +365,16 @@ class ConfigDialog(QDialog):
                 )
                 
                 if response.status_code == 401:
+                    _KEY_VALIDATION_CACHE.pop(cache_key, None)
                     raise APIKeyError("Invalid OpenAI API key")
                 elif response.status_code != 200:
                     raise ConnectionError(f"OpenAI API error: {response.status_code}")
                 
+                _KEY_VALIDATION_CACHE[cache_key] = (True, time.monotonic())
                 showInfo("Connection successful!")
             else:
-                response = requests.post(
+                response = get_session().post(
                     self.lm_studio_url.text(),
-                    headers={"Content-Type": "application/json"},
                     json={
                         "model": "local-model",
                         "messages": [{"role": "user", "content": "test"}],
@@ -232,7 +395,36 @@ class ConfigDialog(QDialog):
         except Exception as e:
             showCritical(str(e))
         
+    def int_field(self, line_edit):
+        """Read an integer from a validated line edit, or None if its input isn't acceptable"""
+        if not line_edit.hasAcceptableInput():
+            return None
+        # Parse with the validator's locale, which may accept group separators
+        # (e.g. "1,000") that int() rejects
+        value, ok = line_edit.validator().locale().toInt(line_edit.text())
+        return value if ok else None
+    
     def save_settings(self):
+        # Numeric fields are validated as they are typed, but may still be
+        # empty or below their minimum; refuse to save until they are fixed
+        numeric_fields = [
+            ("question_field_index", "Question Field Index", self.question_idx),
+            ("answer_field_index", "Answer Field Index", self.answer_idx),
+            ("timeout", "Timeout (seconds)", self.timeout),
+            ("max_retries", "Max Retries", self.max_retries),
+            ("history_turns", "History Turns", self.history_turns),
+        ]
+        numeric_values = {}
+        invalid = []
+        for key, label, line_edit in numeric_fields:
+            value = self.int_field(line_edit)
+            if value is None:
+                invalid.append(label)
+            numeric_values[key] = value
+        if invalid:
+            showCritical("Please enter valid whole numbers for: " + ", ".join(invalid))
+            return
+        
         # Create a new config dictionary
         new_config = {}
         
@@ -245,17 +437,7 @@ class ConfigDialog(QDialog):
         new_config["stream_responses"] = self.stream_responses.isChecked()
         new_config["debug_mode"] = self.debug_mode.isChecked()
         
-        try:
-            new_config["question_field_index"] = int(self.question_idx.text())
-            new_config["answer_field_index"] = int(self.answer_idx.text())
-            new_config["timeout"] = int(self.timeout.text())
-            new_config["max_retries"] = int(self.max_retries.text())
-        except ValueError:
-            showInfo("Numeric fields must contain valid integers. Using defaults.")
-            new_config["question_field_index"] = 0
-            new_config["answer_field_index"] = 1
-            new_config["timeout"] = 30
-            new_config["max_retries"] = 3
+        new_config.update(numeric_values)
         
         # Save the new config
         save_config(new_config)
@@ -264,14 +446,34 @@ class ConfigDialog(QDialog):
         showInfo("Configuration saved successfully!")
         self.accept()
 
+class LLMRunnable(QRunnable):
+    """Runs one LLM request for a quiz dialog on Qt's global thread pool"""
+    def __init__(self, dialog, user_input):
+        super().__init__()
+        self.dialog = dialog
+        self.user_input = user_input
+        
+    def run(self):
+        self.dialog.process_response(self.user_input)
+
 class LLMQuizDialog(QDialog):
+    # chat_display is append-only; never call toHtml()/setHtml() or setPlainText()
+    # on it. Use appendPlainText, or a cursor at End + insertText, only.
+    
+    # Emitted from the worker thread; Qt queues them onto the main thread
+    stream_started = pyqtSignal()
+    stream_text_received = pyqtSignal(str)
+    stream_finished = pyqtSignal()
+    chat_message_received = pyqtSignal(str)
+    response_finished = pyqtSignal()
+    
     def __init__(self, card, parent=None):
         super().__init__(parent)
         self.card = card
         self.note = card.note()
-        self.config = get_config()
-        self.is_streaming = False
-        self.stream_buffer = ""
+        # Snapshot the config so edits made mid-quiz don't change a running dialog
+        self.config = dict(get_config())
+        self.stream_cursor = None
         
         try:
             # Get field indexes from config, with fallbacks
@@ -284,6 +486,8 @@ class LLMQuizDialog(QDialog):
             
             self.question = self.note.fields[question_idx]
             self.answer = self.note.fields[answer_idx]
+            # Lowercased once for the question-echo filter applied to every response
+            self._question_lc = self.question.lower()
             
             self.setWindowTitle("LLM Interactive Quiz")
             self.conversation_history = []
@@ -306,7 +510,8 @@ class LLMQuizDialog(QDialog):
         layout = QVBoxLayout()
         
         # Chat display area
-        self.chat_display = QTextEdit()
+        # Plain text keeps appends and streamed inserts cheap compared to rich text layout
+        self.chat_display = QPlainTextEdit()
         self.chat_display.setReadOnly(True)
         
         # Add a clear method to make debugging easier
@@ -328,6 +533,12 @@ class LLMQuizDialog(QDialog):
         self.setLayout(layout)
         self.resize(700, 500)
         
+        qconnect(self.stream_started, self.start_stream_block)
+        qconnect(self.stream_text_received, self.append_stream_text_safely)
+        qconnect(self.stream_finished, self.end_stream_block)
+        qconnect(self.chat_message_received, self.chat_display.appendPlainText)
+        qconnect(self.response_finished, lambda: self.send_button.setEnabled(True))
+        
     def display_question(self):
         """Displays the flashcard question and sets up the system prompt for the LLM."""
         self.conversation_history = []
@@ -369,27 +580,30 @@ class LLMQuizDialog(QDialog):
 
         self.conversation_history = [{"role": "system", "content": system_prompt}]
 
-        self.chat_display.append(f"<b>Quiz:</b> Question: {self.question}")
+        self.chat_display.appendPlainText(f"Quiz: Question: {strip_html(self.question)}")
 
     def send_message(self):
         user_input = self.input_field.toPlainText()
         if not user_input.strip():
             return
             
-        self.chat_display.append(f"<b>You:</b> {user_input}")
+        self.chat_display.appendPlainText(f"You: {user_input}")
         self.conversation_history.append({"role": "user", "content": user_input})
         self.input_field.clear()
         
         # Disable send button during processing
         self.send_button.setEnabled(False)
         
-        threading.Thread(target=self.process_response, args=(user_input,), daemon=True).start()
+        QThreadPool.globalInstance().start(LLMRunnable(self, user_input))
     
     def process_response(self, user_input):
         """Process the LLM response with retry logic and error handling"""
+        import requests
+        
         retries = 0
         max_retries = self.config.get("max_retries", 3)
         timeout = self.config.get("timeout", 30)
+        messages = self.build_request_messages()
         
         while retries < max_retries:
             try:
@@ -398,15 +612,12 @@ class LLMQuizDialog(QDialog):
                 stream = self.config.get("stream_responses", True)
                 
                 if use_openai and openai_key:
-                    response = requests.post(
+                    response = get_session().post(
                         "https://api.openai.com/v1/chat/completions",
-                        headers={
-                            "Content-Type": "application/json",
-                            "Authorization": f"Bearer {openai_key}"
-                        },
+                        headers={"Authorization": f"Bearer {openai_key}"},
                         json={
                             "model": self.config.get("openai_model", "gpt-3.5-turbo"),
-                            "messages": self.conversation_history,
+                            "messages": messages,
                             "temperature": 0.5,
                             "max_tokens": 150,
                             "stream": stream
@@ -415,12 +626,11 @@ class LLMQuizDialog(QDialog):
                         timeout=timeout
                     )
                 else:
-                    response = requests.post(
+                    response = get_session().post(
                         self.config.get("llm_studio_url", "http://localhost:1234/v1/chat/completions"),
-                        headers={"Content-Type": "application/json"},
                         json={
                             "model": "local-model",
-                            "messages": self.conversation_history,
+                            "messages": messages,
                             "temperature": 0.5,
                             "max_tokens": 150,
                             "stream": stream
@@ -429,9 +639,11 @@ class LLMQuizDialog(QDialog):
                         timeout=timeout
                     )
                 
-                if response.status_code == 401:
-                    raise APIKeyError("Invalid API key")
-                elif response.status_code != 200:
+                if response.status_code != 200:
+                    # Close the (possibly streamed) response so its connection isn't held
+                    response.close()
+                    if response.status_code == 401:
+                        raise APIKeyError("Invalid API key")
                     raise ConnectionError(f"API error: {response.status_code}")
                 
                 if stream:
@@ -444,86 +656,115 @@ class LLMQuizDialog(QDialog):
                     self.add_assistant_response(llm_response)
                 
                 # Re-enable send button on main thread
-                mw.taskman.run_on_main(lambda: self.send_button.setEnabled(True))
+                self.response_finished.emit()
                 return
                 
             except requests.exceptions.ConnectionError:
                 retries += 1
                 if retries >= max_retries:
-                    mw.taskman.run_on_main(
-                        lambda: self.chat_display.append("<b>Error:</b> Connection failed. Make sure the LLM service is running.")
-                    )
+                    self.chat_message_received.emit("Error: Connection failed. Make sure the LLM service is running.")
                 time.sleep(1)  # Wait before retry
                 
             except requests.exceptions.Timeout:
                 retries += 1
                 if retries >= max_retries:
-                    mw.taskman.run_on_main(
-                        lambda: self.chat_display.append("<b>Error:</b> Request timed out.")
-                    )
+                    self.chat_message_received.emit("Error: Request timed out.")
                 time.sleep(1)
                 
             except Exception as e:
-                mw.taskman.run_on_main(
-                    lambda: self.chat_display.append(f"<b>Error:</b> {str(e)}")
-                )
+                self.chat_message_received.emit(f"Error: {str(e)}")
                 break
         
         # Re-enable send button on error
-        mw.taskman.run_on_main(lambda: self.send_button.setEnabled(True))
+        self.response_finished.emit()
+    
+    def build_request_messages(self):
+        """Return the system prompt plus the most recent turns of the conversation"""
+        turns = self.config.get("history_turns", 4)
+        history = self.conversation_history
+        if turns <= 0 or len(history) <= 1 + 2 * turns:
+            return history
+        return [history[0]] + history[-2 * turns:]
     
     def handle_stream_response(self, response):
         """Handle streaming response from LLM"""
-        self.is_streaming = True
-        
         # Add a marker for where we'll insert the streaming text
-        mw.taskman.run_on_main(
-            lambda: self.chat_display.append("<b>Quiz:</b> ")
-        )
+        self.stream_started.emit()
         
         full_response = ""
+        # Resolve the debug flag once so per-token logging costs a single branch
+        debug = _DEBUG_ENABLED
+        
+        # Tokens waiting to be shown, so the UI is updated once per batch
+        # instead of once per token
+        pending = []
+        pending_len = 0
+        last_flush = time.monotonic()
+        
+        think_filter = ThinkTagFilter()
+        
+        def flush_pending():
+            if pending:
+                self.stream_text_received.emit("".join(pending))
+                pending.clear()
+        
+        def flush_remaining():
+            tail = think_filter.flush()
+            if tail:
+                pending.append(tail)
+            flush_pending()
         
         try:
-            for line in response.iter_lines():
+            for line in iter_stream_lines(response):
                 if not line:
                     continue
                 
-                # Decode the line properly
-                try:
-                    line_str = line.decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
+                if line == b"data: [DONE]":
+                    break
                 
+                # Skip keep-alive and role-only frames without parsing them
+                if b'"content"' not in line:
+                    continue
                 
-                if line_str.startswith("data: "):
-                    data = line_str[6:]
+                if line.startswith(b"data: "):
+                    # The JSON parser decodes the UTF-8 payload itself
+                    data = line[6:]
                     
                     try:
-                        json_data = json.loads(data)
+                        json_data = _json_loads(data)
                         
                         if "choices" in json_data and json_data["choices"]:
                             delta = json_data["choices"][0].get("delta", {})
                             content = delta.get("content", "")
                             if content:
-                                debug_print(f"Got content: {content}")
+                                if debug:
+                                    debug_print(f"Got content: {content}")
                                 full_response += content
                                 
-                                # Append the new content
-                                content_to_append = content
-                                mw.taskman.run_on_main(
-                                    lambda text=content_to_append: self.append_stream_text_safely(text)
-                                )
-                    except json.JSONDecodeError as e:
-                        debug_print(f"JSON decode error: {e} - Data: {data}")
+                                # Thinking sections are kept in the history text but never shown
+                                visible = think_filter.feed(content)
+                                if not visible:
+                                    continue
+                                
+                                # Buffer the new content and flush it in batches
+                                pending.append(visible)
+                                pending_len += len(visible)
+                                if (pending_len > STREAM_FLUSH_CHARS
+                                        or time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL):
+                                    flush_pending()
+                                    pending_len = 0
+                                    last_flush = time.monotonic()
+                    except ValueError as e:  # JSONDecodeError or UnicodeDecodeError
+                        if debug:
+                            debug_print(f"JSON decode error: {e} - Data: {data}")
                         continue
         except Exception as e:
             debug_print(f"Streaming error: {e}")
-            error_msg = str(e)
-            mw.taskman.run_on_main(
-                lambda msg=error_msg: self.chat_display.append(f"<b>Error:</b> Streaming failed: {msg}")
-            )
+            flush_remaining()
+            self.chat_message_received.emit(f"Error: Streaming failed: {e}")
         finally:
-            self.is_streaming = False
+            flush_remaining()
+            self.stream_finished.emit()
             
             # Add final response to conversation history
             if full_response:
@@ -533,146 +774,86 @@ class LLMQuizDialog(QDialog):
                 debug_print(f"Final response: {cleaned_response}")
             else:
                 debug_print("No response received")
+            
+            self.release_stream_response(response)
+    
+    def release_stream_response(self, response):
+        """Finish reading a streamed response so its connection returns to the session's pool"""
+        try:
+            # Normally nothing is left after the [DONE] frame
+            for _ in iter_stream_lines(response):
+                pass
+            response.raw.release_conn()
+        except Exception as e:
+            debug_print(f"Could not release streamed connection: {e}")
+            response.close()
+    
+    def start_stream_block(self):
+        """Write the header for a streamed reply and remember where its text goes"""
+        self.chat_display.appendPlainText("Quiz: ")
+        # Keep a cursor at the end of the header so tokens are inserted in place
+        # without searching the document for the current reply
+        self.stream_cursor = QTextCursor(self.chat_display.document())
+        self.stream_cursor.movePosition(QTextCursor.MoveOperation.End)
     
     def append_stream_text_safely(self, text):
         """Safely append text to the current position"""
         try:
-            # Use simple append which is more reliable
-            cursor = self.chat_display.textCursor()
-            cursor.movePosition(QTextCursor.End)
+            cursor = self.stream_cursor
+            if cursor is None:
+                cursor = self.chat_display.textCursor()
+                cursor.movePosition(QTextCursor.MoveOperation.End)
+            # One edit block per flush so the document reports a single change
+            cursor.beginEditBlock()
             cursor.insertText(text)
+            cursor.endEditBlock()
             self.chat_display.setTextCursor(cursor)
             
-            # Ensure visibility
+            # Ensure visibility (once per flushed batch)
             self.chat_display.ensureCursorVisible()
             
         except Exception as e:
             debug_print(f"Error appending text: {e}")
             # Fallback to simple append
             try:
-                current_text = self.chat_display.toPlainText()
-                self.chat_display.setText(current_text + text)
+                self.chat_display.appendPlainText(text)
             except Exception as e2:
                 debug_print(f"Fallback append failed: {e2}")
     
+    def end_stream_block(self):
+        """Forget the insertion point of the finished streamed reply"""
+        self.stream_cursor = None
+    
     def clean_response_text(self, text):
         """Remove thinking tags and clean up response text"""
-        import re
-        
         # Remove <think> tags and their content
-        cleaned = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
+        cleaned = _THINK_RE.sub('', text)
         
         # Remove any standalone newlines at the start
         cleaned = cleaned.lstrip('\n')
         
         # Remove any remaining XML-like tags
-        cleaned = re.sub(r'<[^>]+>', '', cleaned)
+        cleaned = _TAG_RE.sub('', cleaned)
         
         return cleaned.strip()
     
-    def update_placeholder_content(self, placeholder_id, content, final=False):
-        """Update specific placeholder with content"""
-        try:
-            cursor = self.chat_display.textCursor()
-            cursor.movePosition(QTextCursor.MoveOperation.End)
-            
-            # Move back to find our placeholder line
-            found = False
-            for i in range(10):  # Look back up to 10 blocks
-                cursor.movePosition(QTextCursor.MoveOperation.StartOfBlock)
-                cursor.movePosition(QTextCursor.MoveOperation.EndOfBlock, QTextCursor.MoveMode.KeepAnchor)
-                selected_text = cursor.selectedText()
-                
-                if placeholder_id in selected_text:
-                    found = True
-                    break
-                    
-                cursor.movePosition(QTextCursor.MoveOperation.Up)
-            
-            if found:
-                # Replace the line with our content
-                cursor.removeSelectedText()
-                cursor.insertHtml(f"<b>Quiz:</b> {content}")
-            else:
-                # Fallback: append the content
-                cursor.movePosition(QTextCursor.MoveOperation.End)
-                cursor.insertHtml(f"<br><b>Quiz:</b> {content}")
-            
-            # Scroll to bottom
-            self.chat_display.verticalScrollBar().setValue(
-                self.chat_display.verticalScrollBar().maximum()
-            )
-        except Exception as e:
-            debug_print(f"Error updating placeholder: {e}")
-            # Fallback: just append
-            self.chat_display.append(f"<b>Quiz:</b> {content}")
-    
-    def remove_placeholder(self, placeholder_id):
-        """Remove a specific placeholder"""
-        html = self.chat_display.toHtml()
-        placeholder = f'<span id="{placeholder_id}"></span>'
-        
-        if placeholder in html:
-            new_html = html.replace(f"<b>Quiz:</b> {placeholder}", "")
-            self.chat_display.setHtml(new_html)
-    
-    def update_stream_display_with_content(self, content):
-        """Update the display with specific content"""
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(cursor.End)
-        
-        # Find the streaming span
-        cursor.movePosition(cursor.StartOfBlock)
-        cursor.movePosition(cursor.EndOfBlock, cursor.KeepAnchor)
-        
-        selected_text = cursor.selectedText()
-        if "<span id='streaming'>" in selected_text or selected_text.startswith("Quiz:"):
-            # Replace the whole line with the updated content
-            cursor.insertHtml(f"<b>Quiz:</b> {content}")
-            
-        # Scroll to bottom
-        self.chat_display.verticalScrollBar().setValue(
-            self.chat_display.verticalScrollBar().maximum()
-        )
-    
-    def finalize_streamed_response(self, final_content):
-        """Finalize the streamed response display"""
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(cursor.End)
-        
-        # Go to the last quiz response
-        cursor.movePosition(cursor.StartOfBlock)
-        cursor.movePosition(cursor.EndOfBlock, cursor.KeepAnchor)
-        
-        # Replace with the final content
-        cursor.insertHtml(f"<b>Quiz:</b> {final_content}")
-        
-        # Scroll to bottom
-        self.chat_display.verticalScrollBar().setValue(
-            self.chat_display.verticalScrollBar().maximum()
-        )
-    
-    def update_stream_display(self):
-        """Update the display with streamed content"""
-        # This method is now deprecated in favor of update_stream_display_with_content
-        pass
-    
     def add_assistant_response(self, response):
         """Add assistant response to chat display"""
         # Clean the response first
         cleaned_response = self.clean_response_text(response)
         
         # Filter out any responses that still try to repeat the question
-        if cleaned_response.lower().startswith("question:") or self.question.lower() in cleaned_response.lower()[:30]:
+        # (only the start of the response needs lowercasing for this check)
+        head_lc = cleaned_response[:30].lower()
+        if head_lc.startswith("question:") or self._question_lc in head_lc:
             # Skip the question part if the LLM included it
             lines = cleaned_response.split('\n')
-            cleaned_response = '\n'.join([line for line in lines if not line.lower().startswith("question:")])
+            if any(line[:9].lower() == "question:" for line in lines):
+                cleaned_response = '\n'.join([line for line in lines if line[:9].lower() != "question:"])
         
         if cleaned_response.strip():
             self.conversation_history.append({"role": "assistant", "content": cleaned_response})
-            mw.taskman.run_on_main(
-                lambda: self.chat_display.append(f"<b>Quiz:</b> {cleaned_response}")
-            )
+            self.chat_message_received.emit(f"Quiz: {cleaned_response}")
     
     def extract_response_text(self, response):
         # Handle different API response formats
@@ -725,6 +906,9 @@ mw.form.menuTools.addAction(config_action)
 # Register the config action with Anki
 mw.addonManager.setConfigAction(__name__, on_config)
 
+# Keep the cached config in sync with edits made through Anki's add-on manager
+mw.addonManager.setConfigUpdatedAction(__name__, on_config_updated)
+
 # Add a hook to show a button on both the question and answer sides of the card
 def add_llm_button(html, card, kind):
     """Add an LLM Quiz button to both the question and answer sides of the card"""